@@ -31,6 +31,10 @@ if __name__ == '__main__':
                         help="output groups")
     parser.add_argument('-o', '--output', metavar='FILE', #required=True,
                         help="output file")
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                        help="number of processes used for loading files (default: number of CPUs) "
+                             "and rendering groups (default: 2, each one needs memory "
+                             "for heatmap and images of whole extent)")
     parser.add_argument('--max_gap', type=int, metavar='METERS', default=geo.MAX_GAP,
                         help="max gap between coordinates, default: %(default)s")
 
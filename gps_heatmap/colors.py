@@ -2,6 +2,8 @@ import collections
 import colorsys
 import math
 
+import numpy as np
+
 
 """Colors, color manipulation and conversions, color maps calculations."""
 
@@ -178,11 +180,19 @@ class ColorMap(object):
 
     def __init__(self, colors):
         self.colors = colors
+        self._rgba = None
 
     @property
     def steps(self):
         return len(self.colors)
 
+    @property
+    def rgba(self):
+        """Return (steps, 4) uint8 array with RGBA values of all Colors."""
+        if self._rgba is None:
+            self._rgba = np.array([color.rgba for color in self.colors], dtype=np.uint8)
+        return self._rgba
+
     def get(self, value):
         """Return Color associated with given value.
 
@@ -194,6 +204,17 @@ class ColorMap(object):
             n -= 1
         return self.colors[int(n)]
 
+    def get_indices(self, values):
+        """Return array of indices of Colors associated with given array of values.
+
+        Vectorized get(), values = (0., 1.]
+
+        """
+        values = np.asarray(values, dtype=np.float64)
+        n = values / (1./self.steps)
+        n[(values != 0) & (np.floor(n) == n)] -= 1
+        return n.astype(np.intp)
+
     @staticmethod
     def from_gradient(color_min, color_max, steps=256):
         """Return ColorMap as gradient between two colors, with given number of steps."""
@@ -1,6 +1,9 @@
 import collections
 import logging
 import math
+import operator
+
+import numpy as np
 
 
 log = logging.getLogger('gps_heatmap.loaders')
@@ -13,6 +16,7 @@ MAX_GAP = 700
 
 AVG_EARTH_RADIUS = 6371000  # Avarege earth radius in meters
 METERS_PER_DEGREE = 2 * math.pi * AVG_EARTH_RADIUS / 360
+RADIANS_PER_DEGREE = math.pi / 180
 
 
 class Coord(collections.namedtuple('Coord', ['x', 'y'])):
@@ -24,9 +28,7 @@ class Coord(collections.namedtuple('Coord', ['x', 'y'])):
     def distance(self, other):
         if not other:
             return None
-        x = self.x - other.x
-        y = self.y - other.y
-        return math.sqrt(x**2 + y**2)
+        return math.hypot(self.x - other.x, self.y - other.y)
 
     def __repr__(self):
         return '<%s x=%s, y=%s>' % (self.__class__.__name__, self.x, self.y)
@@ -42,27 +44,17 @@ class Point(Coord):
         return Coord.__new__(cls, int(round(x)), int(round(y)))
 
 
-class LatLon(Coord):
+class LatLon(collections.namedtuple('LatLon', ['lat', 'lon'])):
 
     """Geographic Coordinate with longitute and latitude as degrees."""
 
     __slots__ = ()
 
-    @property
-    def lat(self):
-        return self.x
-
-    @property
-    def latitude(self):
-        return self.x
-
-    @property
-    def lon(self):
-        return self.y
-
-    @property
-    def longitude(self):
-        return self.y
+    # NOTE: lat and lon are tuple fields, other names are aliases kept for compatibility
+    x = property(operator.itemgetter(0))
+    y = property(operator.itemgetter(1))
+    latitude = property(operator.itemgetter(0))
+    longitude = property(operator.itemgetter(1))
 
     def distance(self, other):
         """Return distance (in meters) to other LatLon coordinate.
@@ -82,7 +74,7 @@ class LatLon(Coord):
         return math.hypot(x, y) * METERS_PER_DEGREE
 
     def __repr__(self):
-        return '<%s lat=%s, lon=%s>' % (self.__class__.__name__, self.x, self.y)
+        return '<%s lat=%s, lon=%s>' % (self.__class__.__name__, self.lat, self.lon)
 
 
 class Extent(object):
@@ -90,19 +82,40 @@ class Extent(object):
     def __init__(self, coords=None):
         self.min = None
         self.max = None
-        if coords:
+        self._width = None
+        self._height = None
+        if coords is not None:
             self.update(coords)
 
     def update(self, coords):
-        max_x = max(coord.x for coord in coords)
-        min_x = min(coord.x for coord in coords)
-        max_y = max(coord.y for coord in coords)
-        min_y = min(coord.y for coord in coords)
-        coord_cls = self.max and self.max.__class__ or coords[0].__class__
-        self.max = coord_cls(self.max and max(self.max.x, max_x) or max_x, 
-                             self.max and max(self.max.y, max_y) or max_y)
-        self.min = coord_cls(self.min and min(self.min.x, min_x) or min_x, 
-                             self.min and min(self.min.y, min_y) or min_y)
+        """Update extent so it covers all given coords.
+
+        Coords might be also given as (N, 2) array, which is treated as array of Points.
+
+        """
+        if not len(coords):
+            return
+        if self.max:
+            coord_cls = self.max.__class__
+        elif isinstance(coords, np.ndarray):
+            coord_cls = Point
+        else:
+            coord_cls = coords[0].__class__
+        if isinstance(coords, np.ndarray) or len(coords) > 64:
+            coords = np.asarray(coords)
+            min_x, min_y = coords.min(axis=0).tolist()
+            max_x, max_y = coords.max(axis=0).tolist()
+        else:
+            xs, ys = zip(*coords)
+            min_x, min_y = min(xs), min(ys)
+            max_x, max_y = max(xs), max(ys)
+        if self.max:
+            max_x, max_y = max(self.max.x, max_x), max(self.max.y, max_y)
+            min_x, min_y = min(self.min.x, min_x), min(self.min.y, min_y)
+        self.max = coord_cls(max_x, max_y)
+        self.min = coord_cls(min_x, min_y)
+        self._width = self.max.x - self.min.x + 1
+        self._height = self.max.y - self.min.y + 1
 
     def resize(self, size):
         coord_cls = self.max.__class__
@@ -115,18 +128,18 @@ class Extent(object):
     def from_lines(lines, margin=None):
         extent = Extent()
         for line in lines:
-            extent.update(line)
+            extent.update(getattr(line, 'xy', line))
         if margin:
             extent = extent.resize(margin)
         return extent
 
     @property
     def width(self):
-        return self.max.x - self.min.x + 1
+        return self._width
 
     @property
     def height(self):
-        return self.max.y - self.min.y + 1
+        return self._height
 
     @property
     def size(self):
@@ -145,6 +158,27 @@ class Extent(object):
     def __contains__(self, coord):
         return self.is_inside(coord)
 
+    def to_image_array(self, points):
+        """Return (N, 2) array of Points in image coordinates, starting at top-left of extent."""
+        return np.column_stack([points[:, 0] - self.min.x, self.max.y - points[:, 1]])
+
+    def clip_to_image_array(self, points):
+        """Return mask of (N, 2) array's Points inside extent, and all Points in image coordinates.
+
+        Points inside extent are checked on already translated coordinates, in the same pass.
+
+        """
+        image_points = self.to_image_array(points)
+        xs, ys = image_points[:, 0], image_points[:, 1]
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        return inside, image_points
+
+    def contains_array(self, points):
+        """Return mask of (N, 2) array's Points that are inside extent."""
+        xs, ys = points[:, 0], points[:, 1]
+        return ((xs >= self.min.x) & (xs <= self.max.x) &
+                (ys >= self.min.y) & (ys <= self.max.y))
+
     def __iter__(self):
         yield self.min
         yield self.max
@@ -153,42 +187,97 @@ class Extent(object):
         return '<%s min=%r, max=%r>' % (self.__class__.__name__, self.min, self.max)
 
 
+def consecutive_unique(points):
+    """Return mask of (N, 2) array's points that are different than previous ones."""
+    unique = np.ones(len(points), dtype=bool)
+    unique[1:] = np.any(points[1:] != points[:-1], axis=1)
+    return unique
+
+
 class PolyLine(object):
 
-    """List of coordinates."""
+    """Line of Points, stored as (N, 2) array of x, y coordinates.
+
+    Points appended one by one are buffered in a list and merged into array on first access.
+
+    """
 
     def __init__(self):
-        self.coords = []
+        self._xy = np.empty((0, 2), dtype=np.int64)
+        self._appended = []
+        self._extent = None
+
+    @property
+    def xy(self):
+        """Return (N, 2) array of line's Points."""
+        if self._appended:
+            self._xy = np.concatenate([
+                self._xy,
+                np.array(self._appended, dtype=np.int64).reshape(-1, 2),
+            ])
+            self._appended = []
+        return self._xy
+
+    @property
+    def coords(self):
+        return list(self)
+
+    def last(self):
+        if self._appended:
+            return self._appended[-1]
+        if len(self._xy):
+            return Point._make(self._xy[-1].tolist())
 
     def append(self, coord):
-        if (self.coords and not self.coords[-1] == coord) or not self.coords:
-            self.coords.append(coord)
+        if self.last() != coord:
+            self._appended.append(Point(*coord))
+            self._extent = None
 
     def extend(self, coords):
         for coord in coords:
             self.append(coord)
 
+    def extend_array(self, coords):
+        """Extend with (N, 2) array of integer Points, skipping consecutive duplicates."""
+        if not len(coords):
+            return
+        unique = consecutive_unique(coords)
+        if self.last() == tuple(coords[0].tolist()):
+            unique[0] = False
+        self._xy = np.concatenate([self.xy, coords[unique]])
+        self._extent = None
+
     @property
     def extent(self):
-        if self.coords:
-            return Extent(self.coords)
+        """Return bounding box of the line, calculated once until line is changed."""
+        if self._extent is None and len(self):
+            self._extent = Extent(self.xy)
+        return self._extent
+
+    @staticmethod
+    def from_array(coords):
+        """Return PolyLine from (N, 2) array of Points."""
+        line = PolyLine()
+        line.extend_array(coords)
+        return line
 
     def __len__(self):
-        return len(self.coords)
+        return len(self._xy) + len(self._appended)
 
     def __getitem__(self, key):
-        return self.coords[key]
+        if isinstance(key, slice):
+            return list(map(Point._make, self.xy[key].tolist()))
+        return Point._make(self.xy[key].tolist())
 
     def __iter__(self):
-        for coord in self.coords:
-            yield coord
+        return map(Point._make, self.xy.tolist())
 
 
 class Projection(object):
 
     """Base class for geographic projection implementations.
 
-    Child classes must implement project() method.
+    Child classes must implement project() and project_array() methods.
 
     """
 
@@ -227,6 +316,10 @@ class Projection(object):
     def project(self, latlon):
         raise NotImplementedError
 
+    def project_array(self, lats, lons):
+        """Return xs, ys arrays for given arrays of latitudes and longitudes."""
+        raise NotImplementedError
+
     def project_meters(self, latlon):
         coord = self.project(latlon)
         return Coord(coord.x*self.meters_per_pixel, coord.y*self.meters_per_pixel)
@@ -245,6 +338,11 @@ class EquirectangularProjection(Projection):
         y = latlon.lat * self.pixels_per_degree
         return Coord(x, y)
 
+    def project_array(self, lats, lons):
+        xs = np.multiply(lons, self.pixels_per_degree)
+        ys = np.multiply(lats, self.pixels_per_degree)
+        return xs, ys
+
 
 class WebMercatorProjection(Projection):
 
@@ -256,13 +354,21 @@ class WebMercatorProjection(Projection):
     """
 
     EARTH_RADIUS = 6378137  # Approximate Earth radius used in Web Mercator
+    MAX_LATITUDE = 85.0511287798  # Latitudes beyond this limit are not projected
 
     def project(self, latlon):
         x = latlon.lon * self.pixels_per_degree
-        y = self.pixels_per_radian * math.log(
-            math.tan(math.pi/4 + math.radians(latlon.lat/2)))
+        lat = min(max(latlon.lat, -self.MAX_LATITUDE), self.MAX_LATITUDE)
+        # NOTE: atanh(sin(lat)) == log(tan(pi/4 + lat/2)), but is cheaper to compute
+        y = self.pixels_per_radian * math.atanh(math.sin(lat * RADIANS_PER_DEGREE))
         return Coord(x, y)
 
+    def project_array(self, lats, lons):
+        xs = np.multiply(lons, self.pixels_per_degree)
+        lats = np.clip(lats, -self.MAX_LATITUDE, self.MAX_LATITUDE)
+        ys = self.pixels_per_radian * np.arctanh(np.sin(np.radians(lats)))
+        return xs, ys
+
 # Set as alias
 MercatorProjection = WebMercatorProjection
 
@@ -273,25 +379,52 @@ PROJECTIONS = {
 }
 
 
-def get_lines(activity, projection, max_gap=MAX_GAP):
-    """Return PolyLines from given activity using provided Projection.
+def get_distances(lats, lons):
+    """Return distances (in meters) between consecutive coordinates.
+
+    Vectorized version of LatLon.distance(), using the same Equirectangular approximation.
+
+    """
+    coef = np.cos(np.radians(lats[1:]))
+    x = np.diff(lats)
+    y = np.diff(lons) * coef
+    return np.hypot(x, y) * METERS_PER_DEGREE
+
+
+def segment_gaps(distances, max_gap=MAX_GAP):
+    """Return indices of coordinates that are further than max_gap from previous ones."""
+    gaps = np.flatnonzero(distances > max_gap)
+    for gap in gaps:
+        log.warning('Splitting! distance: %d > %d max gap', distances[gap], max_gap)
+    return gaps + 1
+
+
+def project_and_split(lats, lons, projection, max_gap=MAX_GAP, distances=None):
+    """Return list of (N, 2) arrays of projected Points, split on gaps greater than max_gap.
+
+    Distances between consecutive coordinates are calculated if not given.
+
+    """
+    if distances is None:
+        distances = get_distances(lats, lons)
+    xs, ys = projection.project_array(lats, lons)
+    points = np.rint(np.column_stack([xs, ys])).astype(np.int32)
+    return np.split(points, segment_gaps(distances, max_gap))
+
+
+def get_coords(activity, projection, max_gap=MAX_GAP):
+    """Return list of (N, 2) arrays of Points from given activity using provided Projection.
 
     If distance between two coordinates in activity is greater than max_gap split
     activity into separate polylines. This way we can remove strange artifacts 
     when we moved when activity was paused.
 
     """
-    line = PolyLine()
-    prev_latlon = None
-    for latlon in activity:
-        distance = latlon.distance(prev_latlon)
-        prev_latlon = latlon
-        if distance and distance > max_gap:
-            log.warning('Splitting! distance: %d > %d max gap', distance, max_gap)
-            if line:
-                yield line
-            line = PolyLine()
-        coord = Point(*projection.project(latlon))
-        line.append(coord)
-    yield line
+    lats, lons = activity.as_arrays()
+    return project_and_split(lats, lons, projection, max_gap, activity.distances)
+
 
+def get_lines(activity, projection, max_gap=MAX_GAP):
+    """Return PolyLines from given activity using provided Projection, see get_coords()."""
+    for coords in get_coords(activity, projection, max_gap):
+        yield PolyLine.from_array(coords)
@@ -1,73 +1,192 @@
 import collections
 import math
 
-from .geo import Point
+import numpy as np
+
+from .geo import Extent, Point, consecutive_unique
 
 
 class Heatmap(object):
 
-    def __init__(self, clusterer=None):
+    """Heat values of Points stored in dense 2D grid covering heatmap's Extent.
+
+    Value of Point(x, y) is kept in grid[y - extent.min.y, x - extent.min.x].
+    Grid is resized when updated with Points outside of the current Extent.
+
+    """
+
+    def __init__(self, clusterer=None, extent=None, dtype=np.uint32):
         self.clusterer = clusterer or Clusterer()
-        self.points = collections.Counter()
+        self.extent = None
+        self.grid = np.zeros((0, 0), dtype)
+        if extent:
+            self.fit(list(extent))
+
+    def fit(self, points):
+        """Resize grid so it covers all given Points."""
+        extent = Extent(points)
+        if self.extent:
+            if extent.min in self.extent and extent.max in self.extent:
+                return
+            extent.update(list(self.extent))
+        grid = np.zeros((extent.height, extent.width), self.grid.dtype)
+        if self.extent:
+            x, y = extent.translate(self.extent.min)
+            grid[y:y+self.extent.height, x:x+self.extent.width] = self.grid
+        self.extent = extent
+        self.grid = grid
+
+    def indices(self, points):
+        """Return flat grid indices for given (N, 2) array of Points inside extent."""
+        xs = points[:, 0] - self.extent.min.x
+        ys = points[:, 1] - self.extent.min.y
+        return ys * self.extent.width + xs
 
     def __getitem__(self, point):
-        return self.points[point]
+        if not self.extent or not point in self.extent:
+            return 0
+        x, y = self.extent.translate(point)
+        return self.grid.item(y, x)
 
     def __setitem__(self, point, value):
-        self.points[point] = value
+        self.fit([point])
+        x, y = self.extent.translate(point)
+        self.grid[y, x] = value
 
     def get(self, point):
         point = self.clusterer.cluster_point(point)
-        return self.points.get(point, 0)
+        return self[point]
+
+    def get_array(self, points):
+        """Return array of values for given (N, 2) array of Points, vectorized get()."""
+        points = self.clusterer.cluster_coords(points)
+        values = np.zeros(len(points), self.grid.dtype)
+        if self.extent:
+            inside = self.extent.contains_array(points)
+            values[inside] = self.grid.reshape(-1)[self.indices(points[inside])]
+        return values
 
     def __len__(self):
-        return len(self.points)
+        return np.count_nonzero(self.grid)
+
+    def to_arrays(self):
+        """Return (N, 2) array of all Points with non zero value, and array of their values."""
+        if not self.extent:
+            return np.empty((0, 2), dtype=np.int64), self.grid.reshape(-1)
+        ys, xs = np.nonzero(self.grid)
+        points = np.column_stack([xs + self.extent.min.x, ys + self.extent.min.y])
+        return points, self.grid[ys, xs]
+
+    def items(self):
+        """Yield (Point, value) for all Points with non zero value."""
+        points, values = self.to_arrays()
+        for point, value in zip(points.tolist(), values.tolist()):
+            yield Point._make(point), value
 
     def __iter__(self):
-        return self.points.items()
+        return self.items()
+
+    @property
+    def points(self):
+        """Return {Point: value} dict of all Points with non zero value."""
+        return dict(self.items())
+
+    @property
+    def values(self):
+        return self.grid[self.grid != 0]
 
     @property
     def min_value(self):
-        return min(self.points.values())
+        return self.values.min().item()
 
     @property
     def max_value(self):
-        return max(self.points.values())
+        return self.values.max().item()
+
+    def cluster_lines(self, lines):
+        """Return (N, 2) array of clustered Points from all given lines."""
+        points = [self.clusterer.cluster_array(line.xy) for line in lines]
+        if not points:
+            return np.empty((0, 2), dtype=np.int64)
+        return np.concatenate(points)
 
     def update(self, line):
-        line = self.clusterer.cluster_points(line)
-        for point in line:
-            self.points[point] += 1
+        points = self.cluster_lines([line])
+        if not len(points):
+            return
+        self.fit([Point(*points.min(axis=0)), Point(*points.max(axis=0))])
+        np.add.at(self.grid.reshape(-1), self.indices(points), 1)
+
+    def update_points(self, points):
+        """Update with (N, 2) array of already clustered Points, counting all of them in a single pass."""
+        if not len(points):
+            return
+        self.fit([Point(*points.min(axis=0)), Point(*points.max(axis=0))])
+        counts = np.bincount(self.indices(points), minlength=self.grid.size)
+        np.add(self.grid, counts.reshape(self.grid.shape), out=self.grid, casting='unsafe')
+
+    def update_lines(self, lines):
+        """Update with all given lines at once."""
+        self.update_points(self.cluster_lines(lines))
 
     def normalize(self, norm_func=None):
-        """Return normalized Heatmap with max value = 1.0"""
+        """Return normalized Heatmap with max value = 1.0
+
+        norm_func(values, max_value) is called with array of all values in the grid.
+
+        """
         clustered = self.clusterer.cluster_heatmap(self)
         max_value = clustered.max_value
+        values = clustered.grid.astype(np.float32)
         if norm_func:
-            max_value = norm_func(max_value, max_value)
-        normalized = Heatmap(self.clusterer)
-        for point, value in clustered.points.items():
-            if norm_func:
-                value = norm_func(value, max_value)
-            normalized[point] = value*1./max_value
-        return normalized
+            values = norm_func(values, max_value)
+            values[clustered.grid == 0] = 0
+        # NOTE: Divide by max of already normalized float32 values, not by norm_func(max_value)
+        #       calculated with different precision, so the hottest value is exactly 1.0
+        values /= values.max()
+        return Heatmap.from_grid(self.clusterer, clustered.extent, values)
 
     def normalize_log(self):
-        return self.normalize(lambda value, max_value: math.log(value+1))
+        return self.normalize(lambda values, max_value: np.log1p(values))
 
     def get_histogram(self):
         """Return number of points per heat value."""
-        histogram = collections.Counter()
-        for point, value in self.points.items():
-            histogram[value] += 1
-        return histogram
+        values, counts = np.unique(self.values, return_counts=True)
+        return collections.Counter(dict(zip(values.tolist(), counts.tolist())))
+
+    @classmethod
+    def from_grid(cls, clusterer, extent, grid):
+        """Create Heatmap from grid of values covering given Extent."""
+        heatmap = Heatmap(clusterer)
+        heatmap.extent = extent
+        heatmap.grid = grid
+        return heatmap
+
+    @classmethod
+    def from_lines(cls, clusterer, lines, extent=None):
+        """Create Heatmap from Lines.
+
+        If Extent covering all lines is not given it is calculated from lines.
+
+        """
+        heatmap = Heatmap(clusterer)
+        extent = extent or Extent.from_lines(lines)
+        if extent.min:
+            heatmap.fit([heatmap.clusterer.cluster_point(coord) for coord in extent])
+        heatmap.update_lines(lines)
+        return heatmap
 
     @classmethod
-    def from_lines(cls, clusterer, lines):
-        """Create Heatmap from Lines."""
+    def from_points(cls, clusterer, points, extent=None):
+        """Create Heatmap from (N, 2) array of Points already clustered with given clusterer.
+
+        If Extent is given grid covers at least whole (clustered) Extent.
+
+        """
         heatmap = Heatmap(clusterer)
-        for line in lines:
-            heatmap.update(line)
+        if extent and extent.min:
+            heatmap.fit([heatmap.clusterer.cluster_point(coord) for coord in extent])
+        heatmap.update_points(points)
         return heatmap
 
 
@@ -80,6 +199,14 @@ class Clusterer(object):
         for point in line:
             yield point
 
+    def cluster_coords(self, points):
+        """Return clustered Point for each Point in given (N, 2) array, vectorized cluster_point()."""
+        return points
+
+    def cluster_array(self, points):
+        """Return clustered points for given (N, 2) array of line's points."""
+        return points
+
     def cluster_heatmap(self, heatmap):
         return heatmap
 
@@ -106,6 +233,15 @@ class ScaledClusterer(Clusterer):
                 yield cluster_point
             prev_cluster_point = cluster_point
 
+    def cluster_coords(self, points):
+        return np.rint(points * self.cluster_scale).astype(np.int64)
+
+    def cluster_array(self, points):
+        clustered = self.cluster_coords(points)
+        if self.count_cluster_point_once:
+            clustered = clustered[consecutive_unique(clustered)]
+        return clustered
+
 
 class OnceScaledClusterer(ScaledClusterer):
 
@@ -123,44 +259,85 @@ class KernelClusterer(Clusterer):
 
     def __init__(self, radius, *args, **kwargs):
         self.radius = radius
-        self._weights_matrix = {} # = {(x, y): weight, ...}
+        self._kernel = None
+        self._taps = None
+        self._weight_groups = None
 
     def get_weight(self, distance):
+        """Return array of weights for given array of distances from kernel's center."""
         raise NotImplementedError()
 
+    @property
+    def kernel(self):
+        """Return (2*radius+1, 2*radius+1) array of weights, with center at [radius, radius]."""
+        if self._kernel is None:
+            offsets = np.arange(-self.radius, self.radius+1)
+            distance = np.hypot(offsets[:, np.newaxis], offsets[np.newaxis, :])
+            self._kernel = self.get_weight(distance).astype(np.float32)
+        return self._kernel
+
+    @property
+    def taps(self):
+        """Return (xs, ys, weights) flat arrays of kernel's non zero weights and their offsets."""
+        if self._taps is None:
+            ys, xs = np.nonzero(self.kernel)
+            self._taps = (
+                (xs - self.radius).astype(np.int32),
+                (ys - self.radius).astype(np.int32),
+                self.kernel[ys, xs],
+            )
+        return self._taps
+
+    @property
+    def weight_groups(self):
+        """Return list of (weight, xs, ys) with offsets of kernel's taps grouped by weight."""
+        if self._weight_groups is None:
+            xs, ys, weights = self.taps
+            unique_weights, groups = np.unique(weights, return_inverse=True)
+            self._weight_groups = [
+                (weight, xs[groups == i].tolist(), ys[groups == i].tolist())
+                for i, weight in enumerate(unique_weights)
+            ]
+        return self._weight_groups
+
     @property
     def weights_matrix(self):
-        if not self._weights_matrix:
-            for x in range(-self.radius, self.radius+1):
-                for y in range(-self.radius, self.radius+1):
-                    distance = math.hypot(x, y)
-                    weight = self.get_weight(distance)
-                    if weight:
-                        self._weights_matrix[(x, y)] = weight
-        return self._weights_matrix
+        xs, ys, weights = self.taps
+        return dict(zip(zip(xs.tolist(), ys.tolist()), weights.tolist()))
 
     def points(self, point):
-        for (x, y), weight in self.weights_matrix.items():
-            yield Point(point.x+x, point.y+y), weight
+        xs, ys, weights = self.taps
+        for x, y, weight in zip((xs + point.x).tolist(), (ys + point.y).tolist(), weights.tolist()):
+            yield Point(x, y), weight
 
     def cluster_heatmap(self, heatmap):
-        clustered = Heatmap(self)
-        for point, value in heatmap.points.items():
-            clustered_value = 0
-            for kernel_point, weight in self.points(point):
-                value = heatmap.points[kernel_point]
-                if value:
-                    clustered_value += value * weight
-            clustered[point] = clustered_value
-        return clustered
+        """Return Heatmap with values convolved with kernel.
+
+        Only points with non zero value in heatmap are present in clustered Heatmap.
+
+        """
+        grid = heatmap.grid.astype(np.float32)
+        height, width = grid.shape
+        padded = np.pad(grid, self.radius)
+        clustered_grid = np.zeros_like(grid)
+        weighted_sum = np.empty_like(grid)
+        r = self.radius
+        # NOTE: Kernel is radially symmetric, so taps with the same weight are summed first
+        #       and multiplied by weight once per group, not once per tap
+        for weight, xs, ys in self.weight_groups:
+            weighted_sum.fill(0)
+            for x, y in zip(xs, ys):
+                weighted_sum += padded[r+y:r+y+height, r+x:r+x+width]
+            weighted_sum *= weight
+            clustered_grid += weighted_sum
+        clustered_grid[grid == 0] = 0
+        return Heatmap.from_grid(self, heatmap.extent, clustered_grid)
 
 
 class LinearKernelClusterer(KernelClusterer):
 
     def get_weight(self, distance):
-        if distance >= self.radius:
-            return 0
-        return 1. - (distance / self.radius)
+        return np.where(distance < self.radius, 1. - (distance / self.radius), 0)
 
 
 class GaussianKernelClusterer(KernelClusterer):
@@ -170,9 +347,7 @@ class GaussianKernelClusterer(KernelClusterer):
         self.scale = math.log(256) / radius
 
     def get_weight(self, distance):
-        if distance >= self.radius:
-            return 0
-        return math.e ** (-distance * self.scale)
+        return np.where(distance < self.radius, np.power(math.e, -distance * self.scale), 0)
 
 
 CLUSTERERS = {
@@ -1,11 +1,14 @@
+import array
 import logging
 import datetime
 import glob
 import os
+from xml.etree import ElementTree
 
 import gpxpy
+import numpy as np
 
-from .geo import LatLon, Point, get_lines
+from .geo import LatLon, Point, get_distances
 
 
 log = logging.getLogger('gps_heatmap.loaders')
@@ -32,31 +35,52 @@ class Activity(object):
         self.name = name
         self.type = activity_type
         self.date = date
-        self.latlons = [] # = [LatLon, ...]
+        self.lats = array.array('d')
+        self.lons = array.array('d')
+        self._distances = None
 
     def append(self, latlon):
-        self.latlons.append(latlon)
+        self.append_coords(latlon.lat, latlon.lon)
+
+    def append_coords(self, lat, lon):
+        """Append coordinate given as latitude and longitude, without creating LatLon."""
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self._distances = None
+
+    def as_arrays(self):
+        """Return latitudes and longitudes as NumPy arrays.
+
+        Arrays are copies, as views would lock coords arrays and append() would fail.
+
+        """
+        return np.frombuffer(self.lats).copy(), np.frombuffer(self.lons).copy()
+
+    @property
+    def latlons(self):
+        return list(self)
 
     def __iter__(self):
-        for latlon in self.latlons:
-            yield latlon
+        for lat, lon in zip(self.lats, self.lons):
+            yield LatLon(lat, lon)
+
+    @property
+    def distances(self):
+        """Return array of distances (in meters) between consecutive coords."""
+        if self._distances is None:
+            self._distances = get_distances(*self.as_arrays())
+        return self._distances
 
     @property
     def distance(self):
-        distance = 0
-        prev_latlon = None
-        for latlon in self.latlons:
-            if prev_latlon:
-                distance += latlon.distance(prev_latlon)
-            prev_latlon = latlon
-        return distance
+        return self.distances.sum()
 
     @property
     def avg_distance(self):
-        return self.distance / len(self.latlons)
+        return self.distance / len(self)
 
     def __len__(self):
-        return len(self.latlons)
+        return len(self.lats)
 
     def __repr__(self):
         return '<Activity %s fn=%r name=%r>' % (self.type, self.filename, self.name)
@@ -67,6 +91,7 @@ class GPXFileLoader(object):
     """Loads Activities from GPX files."""
 
     def read_file(self, fn):
+        """Yield Activity for each track segment, streaming points from GPX file."""
         base_fn = os.path.basename(fn)
         base_root, ext = os.path.splitext(base_fn)
         if base_root.endswith('-Run') or base_root.endswith('-Running'):
@@ -75,19 +100,48 @@ class GPXFileLoader(object):
             activity_type = ActivityType.RIDE
         else:
             activity_type = ActivityType.NA
-        gpx_file = open(fn, 'r')
-        gpx = gpxpy.parse(gpx_file)
-        date = gpx.time
+        date = None
+        activities = []
+        track_activities = []
+        track_name = None
+        activity = None
+        parents = []
+        for event, element in ElementTree.iterparse(fn, events=('start', 'end')):
+            # NOTE: Ignore namespaces, so both GPX 1.0 and 1.1 files are handled
+            tag = element.tag.rpartition('}')[2]
+            if event == 'start':
+                if tag == 'trk':
+                    track_activities = []
+                    track_name = None
+                elif tag == 'trkseg':
+                    activity = Activity(fn, None, date, activity_type)
+                parents.append(tag)
+                continue
+            parents.pop()
+            if tag == 'trkpt':
+                activity.append_coords(float(element.get('lat')), float(element.get('lon')))
+                element.clear()
+            elif tag == 'trkseg':
+                track_activities.append(activity)
+                element.clear()
+            elif tag == 'trk':
+                # NOTE: Track's name might be given after its segments, so it's set on track's end
+                for activity in track_activities:
+                    activity.name = track_name
+                activities.extend(track_activities)
+                element.clear()
+            elif tag == 'name' and parents[-1] == 'trk':
+                track_name = element.text
+            elif tag == 'time' and parents[-1] in ('gpx', 'metadata'):
+                # NOTE: Same as gpxpy, invalid time is ignored and file mtime is used instead
+                date = gpxpy.gpxfield.TIME_TYPE.from_string(element.text)
         if date is None:
             stat = os.stat(fn)
             tz = gpxpy.gpxfield.SimpleTZ()
             date = datetime.datetime.fromtimestamp(stat.st_mtime, tz)
-        for track in gpx.tracks:
-            for track_segment in track.segments:
-                activity = Activity(fn, track.name, date, activity_type)
-                for point in track_segment.points:
-                    activity.append(LatLon(point.latitude, point.longitude))
-                yield activity
+        for activity in activities:
+            activity.date = date
+            yield activity
 
 
 LOADERS = {
@@ -95,14 +149,19 @@ LOADERS = {
 }
 
 
+def read_file(fn):
+    fn_root, ext = os.path.splitext(fn)
+    loader = LOADERS.get(ext)
+    if not loader:
+        log.warning('Unknown file format: %s', fn)
+        return
+    for activity in loader.read_file(fn):
+        yield activity
+
+
 def read_files(fns):
     for fn in sorted(fns):
-        fn_root, ext = os.path.splitext(fn)
-        loader = LOADERS.get(ext)
-        if not loader:
-            log.warning('Unknown file format: %s', fn)
-            continue
-        for activity in loader.read_file(fn):
+        for activity in read_file(fn):
             yield activity
 
 
@@ -120,3 +179,10 @@ def read(fns=None, fns_pattern=None):
         for activity in read_pattern(fns_pattern):
             yield activity
 
+
+def list_files(fns=None, fns_pattern=None):
+    """Return filenames in the same order as they are read by read()."""
+    files = sorted(fns or [])
+    if fns_pattern:
+        files.extend(sorted(glob.glob(fns_pattern)))
+    return files
@@ -1,3 +1,5 @@
+import concurrent.futures
+import itertools
 import logging
 
 from . import loaders
@@ -34,16 +36,47 @@ EXTENT_MARGIN = 100
 
 
 
+def load_file(fn, projection, max_gap=geo.MAX_GAP):
+    """Return list of (date, coords) for all lines from given file.
+
+    Lines are returned as (N, 2) arrays, so they are cheap to pass between processes.
+
+    """
+    lines = []
+    for activity in loaders.read_file(fn):
+        log.info('Parsing: %s', activity)
+        log.debug('avg_distance: %.2f', activity.avg_distance)
+        for coords in geo.get_coords(activity, projection, max_gap):
+            lines.append((activity.date, coords))
+    return lines
+
+
+def add_lines(lines_ts, files_lines):
+    """Add lines returned by load_file() for each file to Timeseries."""
+    for lines in files_lines:
+        for date, coords in lines:
+            lines_ts.add(date, geo.PolyLine.from_array(coords))
+
+
 def load_lines_ts(fns=None, fns_pattern=None,
-                  projection=None, scale=SCALE, max_gap=geo.MAX_GAP):
+                  projection=None, scale=SCALE, max_gap=geo.MAX_GAP, jobs=None):
+    """Load lines from files, using given number of processes (default: number of CPUs)."""
     if not projection:
         projection = geo.MercatorProjection(scale=scale)
+    fns = loaders.list_files(fns=fns, fns_pattern=fns_pattern)
+    args = (fns, itertools.repeat(projection), itertools.repeat(max_gap))
     lines_ts = Timeseries()
-    for activity in loaders.read(fns=fns, fns_pattern=fns_pattern):
-        log.info('Parsing: %s', activity)
-        log.debug('avg_distance: %.2f', activity.avg_distance)
-        for line in geo.get_lines(activity, projection, max_gap):
-            lines_ts.add(activity.date, line)
+    if jobs == 1 or len(fns) <= 1:
+        # NOTE: Load in this process, so loaded lines are not pickled between processes
+        add_lines(lines_ts, map(load_file, *args))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            add_lines(lines_ts, executor.map(load_file, *args))
+    return lines_ts
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        for lines in executor.map(load_file, *args):
+            for date, coords in lines:
+                lines_ts.add(date, geo.PolyLine.from_array(coords))
     return lines_ts
 
 
@@ -80,7 +113,8 @@ def main(args):
                         format="%(asctime)s - %(levelname)s - %(message)s")
 
     projection = geo.PROJECTIONS[args.projection](args.scale)
-    lines_ts = load_lines_ts(fns=args.files, projection=projection, max_gap=args.max_gap)
+    lines_ts = load_lines_ts(fns=args.files, projection=projection, max_gap=args.max_gap,
+                             jobs=args.jobs)
     clusterer = heatmap.CLUSTERERS[args.clusterer](cluster_scale=args.cluster_scale, 
                                                    radius=args.cluster_radius)
     hsva_min = colors.HEX(args.hsva_min)
@@ -93,7 +127,8 @@ def main(args):
                         background_color=background, 
                         line_width=args.line,
                         extent_margin=args.margin,
-                        blur_radius=args.blur or BLUR_RADIUS)
+                        blur_radius=args.blur or BLUR_RADIUS,
+                        jobs=args.jobs)
     if args.output:
         renderer.render(args.output)
     for group in args.groups or []:
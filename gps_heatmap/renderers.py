@@ -1,11 +1,16 @@
+import concurrent.futures
+import copy
+import functools
+import itertools
 import logging
-import collections
+from collections.abc import Iterable
 import os
 
+import numpy as np
 from PIL import Image, ImageColor, ImageDraw, ImageFilter
 
 from .colors import ColorMap
-from .geo import PolyLine, Extent
+from .geo import Extent
 from .heatmap import Heatmap, ScaledClusterer
 
 
@@ -18,35 +23,46 @@ log = logging.getLogger('gps_heatmap.renderers')
 def split_by_heat_value(line, heatmap, extent=None):
     """Split lines into segments with same Heatmap value.
 
-    If Extent is given return only segments inside this extent.
+    Segments are yielded as flat [x0, y0, x1, y1, ...] lists of coordinates, ready for drawing.
+    If Extent is given return only segments inside this extent, in image coordinates.
 
     """
-    prev_value = None
-    segment = PolyLine()
-    for point in line:
-        if extent and not point in extent:
-            if prev_value and segment:
-                yield prev_value, segment
-            prev_value = None
-            segment = PolyLine()
+    points = line.xy
+    if not len(points):
+        return
+    values = heatmap.get_array(points)
+    if extent:
+        inside, points = extent.clip_to_image_array(points)
+    else:
+        inside = np.ones(len(points), dtype=bool)
+    # NOTE: New segment starts where heat value changes, or line enters / leaves extent
+    breaks = np.flatnonzero((values[1:] != values[:-1]) | (inside[1:] != inside[:-1])) + 1
+    starts = [0, ] + breaks.tolist()
+    ends = breaks.tolist() + [len(points), ]
+    values = values.tolist()
+    inside = inside.tolist()
+    coords = points.ravel().tolist()
+    for start, end in zip(starts, ends):
+        if not inside[start]:
             continue
-        value = heatmap.get(point)
-        if extent:
-            point = extent.translate(point)
-        segment.append(point)
-        if prev_value and not value == prev_value:
-            yield prev_value, segment
-            segment = PolyLine()
-            segment.append(point)
-        prev_value = value
-    if segment:
-        yield prev_value, segment
+        if end < len(points) and inside[end]:
+            # Segment ends at the first point of the next one, so there are no gaps
+            end += 1
+        yield values[start], coords[2*start:2*end]
+
+
+def log_heatmap(heatmap):
+    """Log Heatmap's stats at debug level only, as calculating them scans the whole grid."""
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Heatmap len=%d, min=%s, max=%s', 
+                  len(heatmap), heatmap.min_value, heatmap.max_value)
 
 
 class ImageRenderer(object):
 
-    def __init__(self, lines, clusterer, extent=None, line_width=3):
+    def __init__(self, lines, clusterer, extent=None, line_width=3, points=None):
         self.lines = lines
+        self.points = points
         self.clusterer = clusterer
         self.line_width = line_width
         self._extent = extent
@@ -64,74 +80,101 @@ class ImageRenderer(object):
     @property
     def heatmap(self):
         """Return normalized heatmap."""
-        if not self._normalized_heatmap:
-            if not self._heatmap:
-                heatmap = Heatmap.from_lines(self.clusterer, self.lines)
-                log.info('Heatmap len=%d, min=%d, max=%d', 
-                         len(heatmap), heatmap.min_value, heatmap.max_value)
+        # NOTE: Heatmap's len() counts non zero values in the whole grid, so check for None
+        if self._normalized_heatmap is None:
+            if self._heatmap is None:
+                if self.points is not None:
+                    heatmap = Heatmap.from_points(self.clusterer, self.points, self.extent)
+                else:
+                    heatmap = Heatmap.from_lines(self.clusterer, self.lines, self.extent)
+                log_heatmap(heatmap)
                 self._heatmap = heatmap
             log.info('Clustering and normalizing heatmap values...')
             heatmap = self._heatmap.normalize_log()
-            log.info('Heatmap len=%d, min=%s, max=%s', 
-                     len(heatmap), heatmap.min_value, heatmap.max_value)
+            log_heatmap(heatmap)
             self._normalized_heatmap = heatmap
         return self._normalized_heatmap
 
-    def update(self, lines, update_extent=False):
+    def update(self, lines, update_extent=False, points=None):
+        """Add lines, and update heatmap if already calculated.
+
+        If given, points are already clustered Points of added lines.
+
+        """
         self._normalized_heatmap = None
         if update_extent:
             self._extent = None
-        count = 0
-        for line in lines:
-            count += 1
-            self.lines.append(line)
-            self._heatmap.update(line)
-        heatmap = self._heatmap
-        log.info('Heatmap len=%d, min=%d, max=%d', 
-                 len(heatmap), heatmap.min_value, heatmap.max_value)
-        log.info('Updated with %d lines', count)
+        lines = list(lines)
+        self.lines.extend(lines)
+        if self._heatmap is not None:
+            heatmap = self._heatmap
+            if points is not None:
+                heatmap.update_points(points)
+            else:
+                heatmap.update_lines(lines)
+            log_heatmap(heatmap)
+        elif self.points is not None and points is not None:
+            self.points = np.concatenate([self.points, points])
+        else:
+            self.points = None
+        log.info('Updated with %d lines', len(lines))
 
     def color_lines_gen(self, color_map):
+        extent = self.extent
+        heatmap = self.heatmap
         for line in self.lines:
-            for value, line_segment in split_by_heat_value(line, self.heatmap, self.extent):
-                color = color_map.get(value)
-                yield color, line_segment
+            segments = list(split_by_heat_value(line, heatmap, extent))
+            if not segments:
+                continue
+            values, segments = zip(*segments)
+            for index, line_segment in zip(color_map.get_indices(values).tolist(), segments):
+                yield color_map.colors[index], line_segment
 
     def plot_lines(self, color_map):
         image = Image.new('RGBA', self.extent.size)
         draw = ImageDraw.Draw(image)
         for color, line in self.color_lines_gen(color_map):
             draw.line(line, color.rgba, self.line_width)
-        # NOTE: Flip image, as PIL coordinates starts at top-left!
-        image = image.transpose(Image.FLIP_TOP_BOTTOM)
         return image
 
     def plot_points(self, color_map):
         image = Image.new('RGBA', self.extent.size)
         draw = ImageDraw.Draw(image)
-        for point, value in self.heatmap:
-            color = color_map.get(value)
-            point = self.extent.translate(point)
-            radius = self.line_width/2
-            draw.ellipse((point.x-radius, point.y-radius, point.x+radius, point.y+radius), color.rgba)
-        # NOTE: Flip image, as PIL coordinates starts at top-left!
-        image = image.transpose(Image.FLIP_TOP_BOTTOM)
+        points, values = self.heatmap.to_arrays()
+        # NOTE: PIL coordinates starts at top-left, so y axis is flipped!
+        points = self.extent.to_image_array(points)
+        radius = self.line_width/2
+        rgbas = color_map.rgba[color_map.get_indices(values)].tolist()
+        for (x, y), rgba in zip(points.tolist(), rgbas):
+            draw.ellipse((x-radius, y-radius, x+radius, y+radius), tuple(rgba))
         return image
 
 
 
+def render_group(renderer, lines, points, path):
+    """Render heatmap of given lines (with already clustered points) and save it."""
+    image_renderer = renderer.get_image_renderer(lines, points)
+    image = image_renderer.plot_lines(renderer.color_map)
+    #image = image_renderer.plot_points(renderer.color_map)
+    result = renderer.composite(image)
+    result.save(path)
+
+
 class Renderer(object):
 
     #BLUR_RADIUS = [16, 8, 4, 1]
     BLUR_RADIUS = [10, 5, 1]
     CM_STEPS = 256
+    # NOTE: Each rendering process needs memory for heatmap grids and images of whole extent
+    RENDER_JOBS = 2
 
     def __init__(self, lines_ts, clusterer, 
                  hsva_min, hsva_max, steps=CM_STEPS, 
                  background_color=None, 
                  line_width=3,
                  extent_margin=100,
-                 blur_radius=BLUR_RADIUS):
+                 blur_radius=BLUR_RADIUS,
+                 jobs=None):
         self.lines_ts = lines_ts
         self.clusterer = clusterer
         self.color_map = None
@@ -140,33 +183,50 @@ class Renderer(object):
         self.line_width = line_width
         self.extent_margin = extent_margin
         self._extent = None
+        self._clustered_points = None
         self.blur_radius = blur_radius
+        self.jobs = jobs
+
+    def blur(self, image, radius):
+        # NOTE: Blurs with different radii are composited as separate layers, not applied
+        #       one after another, so they can't be merged into a single blur of combined radius
+        log.debug('Blurring with radius %d', radius)
+        return image.filter(ImageFilter.GaussianBlur(radius))
 
     def post_process(self, image):
-        result = None
-        for radius in self.blur_radius:
-            if not radius:
-                continue
-            log.debug('Blurring with radius %d', radius)
-            blur = image.filter(ImageFilter.GaussianBlur(radius))
-            if result:
-                result = Image.alpha_composite(result, blur)
-            else:
-                result = blur
-        return result
+        radii = [radius for radius in self.blur_radius if radius]
+        bbox = image.getbbox()
+        if not radii or not bbox:
+            return image
+        # NOTE: Blur only the part of image with content (and margin blur can reach),
+        #       as blurred transparent pixels far from content stay transparent
+        margin = 3 * (max(radii) + 1)
+        width, height = image.size
+        left, top, right, bottom = bbox
+        box = (max(left - margin, 0), max(top - margin, 0),
+               min(right + margin, width), min(bottom + margin, height))
+        content = image.crop(box)
+        # NOTE: Pillow releases GIL while blurring, so all radii are blurred in parallel
+        with concurrent.futures.ThreadPoolExecutor(len(radii)) as executor:
+            blurs = list(executor.map(functools.partial(self.blur, content), radii))
+        result = functools.reduce(Image.alpha_composite, blurs)
+        if result.size == image.size:
+            return result
+        image = Image.new('RGBA', image.size)
+        image.paste(result, box[:2])
+        return image
 
     def composite(self, *images):
+        """Return images composited in order, over background color if it is set.
+
+        All images are post processed, except the bottom one when there is no background.
+
+        """
+        layers = list(images)
         if self.background_color:
-            size = images[0].size
-            result = Image.new('RGBA', size, self.background_color.rgb)
-        else:
-            result = None
-        for image in images:
-            if not result:
-                result = image
-            else:
-                result = Image.alpha_composite(result, self.post_process(image))
-        return result
+            layers.insert(0, Image.new('RGBA', layers[0].size, self.background_color.rgb))
+        overlays = [self.post_process(image) for image in layers[1:]]
+        return functools.reduce(Image.alpha_composite, overlays, layers[0])
 
     @property
     def extent(self):
@@ -179,26 +239,44 @@ class Renderer(object):
     def set_color_map(self, hsva_min, hsva_max, steps=CM_STEPS):
         self.color_map = ColorMap.from_gradient(hsva_min, hsva_max, steps)
 
-    def get_image_renderer(self, lines):
-        return ImageRenderer(lines, self.clusterer, self.extent, self.line_width)
+    @property
+    def clustered_points(self):
+        """Return (N, 2) array of clustered Points of all lines, and offsets of each line's Points.
+
+        Points of lines_ts[i] are points[offsets[i]:offsets[i+1]], so they are clustered only
+        once, and reused by all rendered groups.
+
+        """
+        if self._clustered_points is None:
+            points = [self.clusterer.cluster_array(line.xy) for line in self.lines_ts]
+            offsets = np.cumsum([0, ] + [len(line_points) for line_points in points])
+            if points:
+                points = np.concatenate(points)
+            else:
+                points = np.empty((0, 2), dtype=np.int64)
+            self._clustered_points = (points, offsets)
+        return self._clustered_points
+
+    def get_image_renderer(self, lines, points=None):
+        return ImageRenderer(lines, self.clusterer, self.extent, self.line_width, points)
 
     def get_path(self, base, group_name, group, group_format=None):
         fn = [base, ]
         fn.append(group_name)
         if group:
-            if group_format and isinstance(group, collections.Iterable):
+            is_iterable = not isinstance(group, str) and isinstance(group, Iterable)
+            if group_format and is_iterable:
                 fn.append(group_format % tuple(group))
             elif group_format:
                 fn.append(group_format % group)
-            elif isinstance(group, collections.Iterable):
+            elif is_iterable:
                 fn.append('_'.join(str(e) for e in group))
             else:
                 fn.append(str(group))
         #fn.append(self.clusterer.__class__.__name__)
         fn = '__'.join(fn) + '.png'
         if group:
-            if not os.path.exists(group_name):
-                os.mkdir(group_name)
+            os.makedirs(group_name, exist_ok=True)
             path = os.path.join(group_name, fn)
         else:
             path = fn
@@ -206,22 +284,47 @@ class Renderer(object):
 
     def render_groups(self, base, group_name, group_format=None, cumulative=True):
         image_renderer = None
+        all_points, offsets = self.clustered_points
+        path_name = group_name
+        if not cumulative:
+            path_name = group_name.replace('ly', 's')
+        separate_groups = []
+        # NOTE: Groups are yielded in the same order as lines_ts, so each group is a slice of it
+        start = 0
         for group, lines in getattr(self.lines_ts, group_name):
             log.info('Heatmap for %s - adding %d lines', group or group_name, len(lines))
-            if image_renderer and cumulative:
-                image_renderer.update(lines)
+            end = start + len(lines)
+            points = all_points[offsets[start]:offsets[end]]
+            start = end
+            path = self.get_path(base, path_name, group, group_format)
+            if not cumulative:
+                separate_groups.append((lines, points, path))
+                continue
+            if image_renderer:
+                image_renderer.update(lines, points=points)
             else:
-                image_renderer = self.get_image_renderer(lines)
+                image_renderer = self.get_image_renderer(lines, points)
             image = image_renderer.plot_lines(self.color_map)
             #image = image_renderer.plot_points(self.color_map)
             result = self.composite(image)
-            if not cumulative:
-                group_name = group_name.replace('ly', 's')
-            path = self.get_path(base, group_name, group, group_format)
             result.save(path)
+        if separate_groups:
+            self.render_separate_groups(separate_groups)
+
+    def render_separate_groups(self, groups):
+        """Render list of (lines, points, path) groups, each one in separate process."""
+        # NOTE: Groups don't share any state, and workers need only lines of rendered group
+        renderer = copy.copy(self)
+        renderer._extent = self.extent
+        renderer.lines_ts = None
+        renderer._clustered_points = None
+        lines, points, paths = zip(*groups)
+        jobs = min(self.jobs or self.RENDER_JOBS, len(groups))
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            list(executor.map(render_group, itertools.repeat(renderer), lines, points, paths))
 
     def render(self, output_fn='heatmap.png'):
-        image_renderer = self.get_image_renderer(self.lines_ts)
+        image_renderer = self.get_image_renderer(self.lines_ts, self.clustered_points[0])
         image = image_renderer.plot_lines(self.color_map)
         #image = image_renderer.plot_points(self.color_map)
         result = self.composite(image)
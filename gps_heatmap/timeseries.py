@@ -1,5 +1,5 @@
-import bisect
 import collections
+import itertools
 
 
 """Simple timeseries for grouping values by year, quarter, month, week, day."""
@@ -12,7 +12,7 @@ def year_group(date):
     return (date.year, )
 
 def quarter_group(date):
-    return (date.year, (date.month-1)/3+1)
+    return (date.year, (date.month-1)//3+1)
 
 def month_group(date):
     return (date.year, date.month)
@@ -30,38 +30,35 @@ class Timeseries(object):
     """Keeps values sorted by date."""
 
     def __init__(self):
-        self._dates = []
         self._values = collections.defaultdict(list)
+        self._dates = None
 
     def add(self, date, value):
-        index = bisect.bisect_left(self._dates, date)
-        if not (len(self._dates) > index and self._dates[index] == date):
-            self._dates.insert(index, date)
         self._values[date].append(value)
+        self._dates = None
+
+    @property
+    def sorted_dates(self):
+        """Return sorted list of all dates, sorted once after values are added."""
+        if self._dates is None:
+            self._dates = sorted(self._values)
+        return self._dates
 
     def __len__(self):
         return sum(len(values) for values in self._values.values())
 
     def __iter__(self):
-        for date in self._dates:
+        for date in self.sorted_dates:
             for value in self._values[date]:
                 yield value
 
     def _grouped_values(self, group_func=None):
         if not group_func:
             yield None, self
-        values = []
-        prev_group = None
-        for date in self._dates:
-            group = group_func(date)
-            if prev_group and not group == prev_group:
-                yield prev_group, values
-                values = []
-            for value in self._values[date]:
-                values.append(value)
-            prev_group = group
-        if values:
-            yield prev_group, values
+            return
+        # NOTE: Values of all dates in group are joined into list at once, instead of one by one
+        for group, dates in itertools.groupby(self.sorted_dates, group_func):
+            yield group, list(itertools.chain.from_iterable(self._values[date] for date in dates))
 
     @property
     def all(self):
@@ -6,6 +6,17 @@ import srtm
 log = logging.getLogger('gps_heatmap.utils')
 
 
+_elevation_data = None
+
+
+def get_elevation_data():
+    """Return SRTM elevation data, shared by all calls so loaded tiles are reused."""
+    global _elevation_data
+    if _elevation_data is None:
+        _elevation_data = srtm.get_data()
+    return _elevation_data
+
+
 def remove_waypoints(gpx):
     """Remove all waypoints."""
     gpx.waypoints = []
@@ -14,6 +25,6 @@ def remove_waypoints(gpx):
 
 def fix_elevation(gpx):
     """Fix elevation data using SRTM database."""
-    elevation_data = srtm.get_data()
+    elevation_data = get_elevation_data()
     elevation_data.add_elevations(gpx, smooth=True)
     return gpx